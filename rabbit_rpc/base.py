@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 import logging
 import functools
+import time
 from threading import Lock
 
 import pika
 
+from .credentials import apply_credentials
+from .utils import Backoff
+
 logger = logging.getLogger(__name__)
 
 _lock = Lock()
@@ -15,11 +19,23 @@ class Connector(object):
     DEFUALT_QUEUE = 'default'
     EXCHANGE_TYPE = 'direct'
 
-    def __init__(self, amqp_url=None, conn_parameters=None, exchange='default'):
+    def __init__(self, amqp_url=None, conn_parameters=None, exchange='default',
+                 credentials_provider=None, backoff=None, prefetch_count=10):
+        """
+        :param credentials_provider: An object with ``get_username`` and
+                                     ``get_password`` methods, evaluated on
+                                     every connect.
+        :param Backoff backoff: The delays between reconnection attempts.
+        :param int prefetch_count: The number of unacked messages RabbitMQ
+                                   delivers to each consumer.
+        """
         assert any((amqp_url, conn_parameters)), 'must be provide amqp_url or conn_parameters'
 
         self._url = amqp_url
         self._exchange = exchange
+        self.credentials_provider = credentials_provider
+        self._backoff = backoff or Backoff()
+        self.prefetch_count = prefetch_count
 
         self._channel = None
         self._connection = None
@@ -39,9 +55,11 @@ class Connector(object):
         :rtype: pika.SelectConnection
 
         """
+        apply_credentials(self.conn_parameters, self.credentials_provider)
         return pika.SelectConnection(
             self.conn_parameters,
             on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
             on_close_callback=self.on_connection_closed)
 
     def on_connection_open(self, unused_connection):
@@ -55,40 +73,35 @@ class Connector(object):
         logger.info('Connection opened..')
         self.open_channel()
 
-    def on_connection_closed(self, connection, reply_code, reply_text):
+    def on_connection_open_error(self, unused_connection, err):
+        """This method is called by pika if the connection to RabbitMQ
+        can't be established. The IOLoop is stopped and run will retry.
+
+        :param pika.SelectConnection unused_connection:
+        :param Exception err: The error
+
+        """
+        logger.error('Connection open failed: %s', err)
+        self._connection.ioloop.stop()
+
+    def on_connection_closed(self, connection, reason):
         """This method is invoked by pika when the connection to RabbitMQ is
-        closed unexpectedly. Since it is unexpected, we will reconnect to
-        RabbitMQ if it disconnects.
+        closed. The IOLoop is stopped, run will reconnect to RabbitMQ unless
+        we are closing.
 
         :param pika.connection.Connection connection: The closed connection obj
-        :param int reply_code: The server provided reply_code if given
-        :param str reply_text: The server provided reply_text if given
+        :param Exception reason: exception representing reason for loss of
+            connection.
 
         """
         self._channel = None
-        if self._closing:
-            self._connection.ioloop.stop()
-        else:
+        if not self._closing:
             logger.info(
-                'Connection was closed unexpected, we will try to reconnect it..')
-            self._connection.add_timeout(1, self.reconnect)
+                'Connection was closed unexpected, we will try to reconnect it: '
+                '%s', reason)
 
-    def reconnect(self):
-        """Will be invoked by the IOLoop timer if the connection is
-        closed. See the on_connection_closed method.
-
-        """
-        # This is the old connection IOLoop instance, stop its ioloop
         self._connection.ioloop.stop()
 
-        if not self._closing:
-
-            # Create a new connection
-            self._connection = self.connect()
-
-            # There is now a new connection, needs a new ioloop to run
-            self._connection.ioloop.start()
-
     def open_channel(self):
         self._connection.channel(on_open_callback=self.on_channel_open)
 
@@ -104,7 +117,7 @@ class Connector(object):
         logger.info('Channel opened..')
 
         self._channel = channel
-        self._channel.basic_qos(prefetch_count=10)
+        self._channel.basic_qos(prefetch_count=self.prefetch_count)
         self.add_on_channel_close_callback()
         if self._exchange:
             self.setup_exchange(self._exchange, True)
@@ -116,7 +129,7 @@ class Connector(object):
         """
         self._channel.add_on_close_callback(self.on_channel_closed)
 
-    def on_channel_closed(self, channel, reply_code):
+    def on_channel_closed(self, channel, reason):
         """Invoked by pika when RabbitMQ unexpectedly closes the channel.
         Channels are usually closed if you attempt to do something that
         violates the protocol, such as re-declare an exchange or queue with
@@ -124,11 +137,14 @@ class Connector(object):
         to shutdown the object.
 
         :param pika.channel.Channel: The closed channel
-        :param int reply_code: The numeric reason the channel was closed
-        :param str reply_text: The text reason the channel was closed
+        :param Exception reason: Why the channel was closed, e.g.
+            ChannelClosedByBroker with the reply code and text.
 
         """
-        logger.info('Channel closed..')
+        if self._closing:
+            logger.info('Channel closed..')
+        else:
+            logger.warning('Channel closed: %s', reason)
         self.close_connection()
 
     def setup_exchange(self, exchange_name, durable=False):
@@ -158,6 +174,10 @@ class Connector(object):
 
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
+        if self._connection is None or self._connection.is_closing or \
+                self._connection.is_closed:
+            return
+
         self._connection.close()
 
     def close_channel(self):
@@ -168,14 +188,32 @@ class Connector(object):
         if self._channel is not None:
             self._channel.close()
 
+    def add_callback_threadsafe(self, callback):
+        """Run the callback on the IOLoop thread, it is safe to call from
+        other threads and signal handlers.
+
+        """
+        if self._connection is not None:
+            self._connection.ioloop.add_callback_threadsafe(callback)
+
     def run(self):
-        """Run by connecting and then starting the IOLoop."""
+        """Run by connecting and then starting the IOLoop. Whenever the
+        IOLoop stops without closing, wait for the backoff delay and connect
+        again, so reconnecting never nests IOLoops.
 
-        # make sure one processor one connection
-        with _lock:
-            self._connection = self.connect()
+        """
+        while not self._closing:
+            # make sure one processor one connection
+            with _lock:
+                self._connection = self.connect()
+
+            self._connection.ioloop.start()
+            if self._closing:
+                break
 
-        self._connection.ioloop.start()
+            delay = self._backoff.next_delay()
+            logger.info('Reconnecting in %.2fs..', delay)
+            time.sleep(delay)
 
     def stop(self):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """Fail fast on a remote consumer after consecutive failures.
+
+    The breaker opens once ``failure_threshold`` calls in a row have failed.
+    While open every call is refused, after ``reset_timeout`` seconds a single
+    probe call is let through (half-open), its outcome closes the breaker or
+    opens it again.
+
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+
+        if time.time() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+
+        return self.OPEN
+
+    def allow(self):
+        """Return True if a call may be sent now."""
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info('Circuit of %s is closed.', self.name)
+
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warning('Circuit of %s is open.', self.name)
+
+                self._opened_at = time.time()
+                self._probing = False
+
+    def __repr__(self):
+        return '<CircuitBreaker %s: %s>' % (self.name, self.state)
@@ -2,22 +2,94 @@
 import logging
 import json
 import time
+import types
 import uuid
+import weakref
+from collections import OrderedDict, deque
 
 import pika
-
-from .exceptions import (ERROR_FLAG, HAS_ERROR, NO_ERROR, RemoteFunctionError,
-                         RemoteCallTimeout)
+from pika.exceptions import AMQPConnectionError, AMQPError
+
+from .breaker import CircuitBreaker
+from .credentials import apply_credentials
+from .exceptions import (ERROR_FLAG, HAS_ERROR, NO_ERROR, OVERLOADED,
+                         BrokerUnavailable, CircuitOpenError,
+                         PayloadUnavailable, RemoteFunctionError,
+                         RemoteCallTimeout, RemoteServerOverloaded)
+from .idempotency import IDEMPOTENCY_KEY
+from .shm import SHM_ACCEPT, SharedMemoryTransport
+from .tracing import (NOOP_EXPORTER, REPLIED_AT, SENT_AT, SPAN_ID, TIMING,
+                      TRACE_ID, Span, current_trace_id, new_id, now_us)
+from .utils import Backoff, LatencyTracker
 
 logger = logging.getLogger(__name__)
 
 
 class RPCClient(object):
 
-    def __init__(self, amqp_url=None, conn_parameters=None, exchange='default'):
+    # Responses of discarded calls that never arrive, e.g. after a worker
+    # crash, are forgotten after DISCARD_TTL seconds or beyond MAX_DISCARDED.
+    DISCARD_TTL = 600.0
+    MAX_DISCARDED = 10000
+
+    def __init__(self, amqp_url=None, conn_parameters=None, exchange='default',
+                 failure_threshold=None, reset_timeout=30.0,
+                 hedge_percentile=95, credentials_provider=None, backoff=None,
+                 max_buffered=1000, trace=False, exporter=None,
+                 shm_threshold=None, shm_dir=None, shm_max_age=600.0):
+        """
+        :param int failure_threshold: Open the circuit of a consumer after the
+                                      number of consecutive failed calls.
+                                      None disables circuit breaking.
+        :param float reset_timeout: Seconds an open circuit waits before
+                                    probing the consumer again.
+        :param float hedge_percentile: The latency percentile after which a
+                                       hedged call sends its duplicate.
+        :param credentials_provider: An object with ``get_username`` and
+                                     ``get_password`` methods, evaluated on
+                                     every connect.
+        :param Backoff backoff: The delays between reconnection attempts.
+        :param int max_buffered: The number of messages kept while the broker
+                                 is unreachable, BrokerUnavailable is raised
+                                 beyond it.
+        :param bool trace: Stamp calls with trace ids and send time, the
+                           timing breakdown of the last call is then exposed
+                           as ``last_timing``.
+        :param Exporter exporter: Receives a span for every traced call,
+                                  implies ``trace``.
+        :param int shm_threshold: Pass arguments and results of at least this
+                                  many bytes through shared memory, only for
+                                  workers on the same host started with
+                                  ``--shm-threshold``. None disables it.
+        :param str shm_dir: The shared memory directory, /dev/shm by default.
+        :param float shm_max_age: Seconds after which unread payloads are
+                                  removed, longer than calls may wait in
+                                  the queue.
+        """
         assert any((amqp_url, conn_parameters)), 'must be provide amqp_url or conn_parameters'
 
         self._results = {}
+        self._stubs = {}
+        # correlation id => when it was discarded
+        self._discarded = OrderedDict()
+        self._breakers = {}
+        self._latencies = {}
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_percentile = hedge_percentile
+        self.credentials_provider = credentials_provider
+        self.max_buffered = max_buffered
+        self._backoff = backoff or Backoff()
+        self._next_attempt = 0
+        self._outbox = deque()
+        self.trace = trace or exporter is not None
+        self._exporter = exporter or NOOP_EXPORTER
+        self._timings = {}
+        self._last_trace = None
+        self._shm = None
+        if shm_threshold is not None:
+            self._shm = SharedMemoryTransport(shm_threshold, shm_dir,
+                                              shm_max_age)
         self._exchange = exchange
         self.url = amqp_url
         self.callback_queue = None
@@ -30,114 +102,521 @@ class RPCClient(object):
         self.connect()
 
     def connect(self):
+        apply_credentials(self.conn_parameters, self.credentials_provider)
         self.connection = pika.BlockingConnection(self.conn_parameters)
         self.channel = self.connection.channel()
 
+    @property
+    def is_connected(self):
+        return self.connection.is_open and self.channel.is_open
+
+    def ensure_connection(self):
+        """Reconnect if the connection was lost and the backoff delay has
+        elapsed, then send the buffered messages. Returns whether the client
+        is connected.
+
+        """
+        if self.is_connected:
+            return True
+
+        if self.connection.is_open:
+            # Only the channel was closed, e.g. by the broker on a publish to
+            # a missing exchange.
+            try:
+                self.reopen_channel()
+                self.flush_outbox()
+                return True
+            except AMQPConnectionError as ex:
+                logger.warning('Connection lost: %r', ex)
+
+        now = time.time()
+        if now < self._next_attempt:
+            return False
+
+        # The exclusive callback queue is gone with the old connection.
+        had_callback_queue = self.callback_queue is not None
+        self.callback_queue = None
+        self.close_connection()
+        try:
+            self.connect()
+            if had_callback_queue:
+                self.setup_callback_queue()
+        except AMQPError as ex:
+            delay = self._backoff.next_delay()
+            self._next_attempt = now + delay
+            logger.warning('Reconnect failed, retry in %.2fs: %r', delay, ex)
+            return False
+
+        logger.info('Reconnected..')
+        self._backoff.reset()
+        self.flush_outbox()
+        return True
+
+    def reopen_channel(self):
+        self.channel = self.connection.channel()
+        # The callback queue was consumed on the closed channel.
+        if self.callback_queue is not None:
+            self.callback_queue = None
+            self.setup_callback_queue()
+
+    def close_connection(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except AMQPError:
+            pass
+
     def setup_callback_queue(self):
         if not self.callback_queue:
             ret = self.channel.queue_declare(
                 '', exclusive=True, auto_delete=True)
             self.callback_queue = ret.method.queue
             self.channel.queue_bind(self.callback_queue, self._exchange)
+
+            # The channel must not keep the client alive, or __del__ would
+            # never close the connection.
+            ref = weakref.ref(self)
+
+            def on_response(*args):
+                client = ref()
+                if client is not None:
+                    client.on_response(*args)
+
             self.channel.basic_consume(
                 queue=self.callback_queue,
-                on_message_callback=self.on_response)
+                on_message_callback=on_response)
 
     def on_response(self, channel, basic_deliver, props, body):
+        if props.correlation_id in self._discarded:
+            del self._discarded[props.correlation_id]
+            if self._shm is not None:
+                self._shm.discard(props.headers)
+            return
+
+        if self._shm is not None:
+            try:
+                body = self._shm.load(props.headers, body)
+            except PayloadUnavailable as ex:
+                self._results[props.correlation_id] = RemoteFunctionError(
+                    str(ex))
+                return
+            self._shm.discard(props.headers)
+
         ret = json.loads(body)
-        if props.headers.get(ERROR_FLAG, NO_ERROR) == HAS_ERROR:
+        error_flag = props.headers.get(ERROR_FLAG, NO_ERROR)
+        if error_flag == HAS_ERROR:
             ret = RemoteFunctionError(ret)
+        elif error_flag == OVERLOADED:
+            ret = RemoteServerOverloaded(ret)
 
         self._results[props.correlation_id] = ret
 
-    def get_response(self, correlation_id, timeout=None):
-        stoploop = time.time() + timeout if timeout is not None else 0
-        while stoploop > time.time() or timeout is None:
-            self.connection.process_data_events()
-            if correlation_id in self._results:
-                return self._results.pop(correlation_id)
-            self.connection.sleep(0.1)
+        timing = props.headers.get(TIMING)
+        if timing is not None:
+            timing = dict(timing)
+            timing['reply'] = now_us() - props.headers[REPLIED_AT]
+            self._timings[props.correlation_id] = (
+                props.headers.get(TRACE_ID), props.headers.get(SPAN_ID),
+                timing)
+
+    @property
+    def last_timing(self):
+        """The timing breakdown in microseconds of the last traced call:
+        broker_wait, queue_wait, execute, reply and total.
+
+        """
+        if self._last_trace is not None:
+            return self._last_trace[2]
+
+    def get_response(self, correlation_id, timeout=None, hedge=None,
+                     hedge_delay=None):
+        """Wait for the response of the call.
+
+        :param callable hedge: Invoked once after ``hedge_delay`` seconds to
+                               send a duplicate call, returns its correlation
+                               id. The first response wins, the others are
+                               discarded when they arrive.
+        """
+        now = time.time()
+        stoploop = now + timeout if timeout is not None else 0
+        hedge_at = now + hedge_delay if hedge is not None else None
+        corr_ids = [correlation_id]
+
+        try:
+            while stoploop > time.time() or timeout is None:
+                self.process_data_events()
+                for corr_id in corr_ids:
+                    if corr_id in self._results:
+                        corr_ids.remove(corr_id)
+                        self._last_trace = self._timings.pop(corr_id, None)
+                        return self._results.pop(corr_id)
+
+                wait = 0.1
+                if hedge_at is not None:
+                    wait = hedge_at - time.time()
+                    if wait <= 0:
+                        corr_ids.append(hedge())
+                        hedge_at = None
+                        continue
+                    wait = min(wait, 0.1)
+
+                self.sleep(wait)
+        finally:
+            for corr_id in corr_ids:
+                self.discard_response(corr_id)
 
         raise RemoteCallTimeout()
 
-    def publish_message(self, exchange, routing_key, body, headers=None):
+    def process_data_events(self):
+        if not self.ensure_connection():
+            return
+
+        try:
+            self.connection.process_data_events()
+        except AMQPConnectionError as ex:
+            logger.warning('Connection lost: %r', ex)
+
+    def sleep(self, seconds):
+        if self.is_connected:
+            self.connection.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def publish_message(self, exchange, routing_key, body, headers=None,
+                        priority=None, reply=None):
+        """Publish the call, it is buffered if the broker is unreachable
+        and sent once the client reconnects.
+
+        :param bool reply: Whether the consumer should reply, defaults to
+                           whether the callback queue has been set up.
+        """
         corr_id = str(uuid.uuid4())
+        if self.trace:
+            headers = dict(headers or {})
+            headers[TRACE_ID] = current_trace_id() or new_id(16)
+            headers[SPAN_ID] = new_id()
+            headers[SENT_AT] = now_us()
+
+        if reply is None:
+            reply = self.callback_queue is not None
+
+        body = json.dumps(body)
+        if self._shm is not None:
+            headers = dict(headers or {})
+            headers[SHM_ACCEPT] = 1
+            body = self._shm.dump(body, headers)
+
+        message = (exchange, routing_key, body, headers, priority, corr_id,
+                   reply)
+
+        # Always give the client a chance to reconnect, fire-and-forget
+        # callers never process data events.
+        connected = self.ensure_connection()
+        if connected and self._outbox:
+            self.flush_outbox()
+
+        # Only a lost connection is buffered, channel errors such as a
+        # missing exchange are the caller's.
+        if connected and not self._outbox:
+            try:
+                self._send(message)
+                return corr_id
+            except AMQPConnectionError as ex:
+                logger.warning('Connection lost: %r', ex)
+
+        if len(self._outbox) >= self.max_buffered:
+            raise BrokerUnavailable(
+                'Broker is unreachable and %d messages are buffered.' %
+                len(self._outbox))
+
+        self._outbox.append(message)
+        return corr_id
+
+    def _send(self, message):
+        exchange, routing_key, body, headers, priority, corr_id, reply = message
+        if reply:
+            self.setup_callback_queue()
 
         self.channel.basic_publish(
             exchange=exchange,
             routing_key=routing_key,
             properties=pika.BasicProperties(
-                reply_to=self.callback_queue,
+                reply_to=self.callback_queue if reply else None,
                 headers=headers,
                 correlation_id=corr_id,
+                priority=priority,
             ),
-            body=json.dumps(body))
+            body=body)
 
-        return corr_id
+    def flush_outbox(self):
+        """Send the messages buffered during the outage in order."""
+        while self._outbox:
+            try:
+                self._send(self._outbox[0])
+            except AMQPConnectionError as ex:
+                logger.warning('Connection lost: %r', ex)
+                return
+            except AMQPError as ex:
+                # Nobody waits for the error of a buffered message, drop it
+                # rather than blocking the ones behind it.
+                logger.error('Dropped a buffered message: %r', ex)
+                self._outbox.popleft()
+                try:
+                    if not self.channel.is_open:
+                        self.reopen_channel()
+                except AMQPConnectionError as ex:
+                    logger.warning('Connection lost: %r', ex)
+                    return
+                continue
+
+            self._outbox.popleft()
 
     def skip_response(self, correlation_id):
         self._results.pop(correlation_id, None)
 
+    def discard_response(self, correlation_id):
+        """Drop the response of the call whenever it arrives."""
+        self._timings.pop(correlation_id, None)
+        if correlation_id in self._results:
+            del self._results[correlation_id]
+            return
+
+        now = time.time()
+        self._discarded[correlation_id] = now
+
+        expired = now - self.DISCARD_TTL
+        while self._discarded:
+            discarded_at = next(iter(self._discarded.values()))
+            if discarded_at >= expired and \
+                    len(self._discarded) <= self.MAX_DISCARDED:
+                break
+            self._discarded.popitem(last=False)
+
+    def export_span(self, consumer_name, total):
+        trace_id, span_id, timing = self._last_trace
+        timing['total'] = total
+        if self._exporter.enabled:
+            self._exporter.export(
+                Span(trace_id, span_id, consumer_name, 'client', timing))
+
+    def get_breaker(self, consumer_name):
+        """Return the circuit breaker of the consumer, or None if circuit
+        breaking is disabled.
+
+        """
+        if self.failure_threshold is None:
+            return None
+
+        try:
+            return self._breakers[consumer_name]
+        except KeyError:
+            breaker = CircuitBreaker(
+                consumer_name, self.failure_threshold, self.reset_timeout)
+            self._breakers[consumer_name] = breaker
+            return breaker
+
+    def get_hedge_delay(self, consumer_name):
+        """Return the seconds to wait before hedging a call, or None if
+        there are not enough latency samples yet.
+
+        """
+        tracker = self._latencies.get(consumer_name)
+        if tracker is None:
+            return None
+
+        return tracker.percentile(self.hedge_percentile)
+
+    def record_latency(self, consumer_name, latency):
+        try:
+            tracker = self._latencies[consumer_name]
+        except KeyError:
+            tracker = self._latencies[consumer_name] = LatencyTracker()
+
+        tracker.add(latency)
+
     def call(self, consumer_name):
+        """Return the stub calling the remote consumer, stubs are cached per
+        consumer name.
 
-        def func(*args, **kwargs):
-            """Call the remote function.
-
-            :param bool ignore_result: Ignore the result return immediately.
-            :param str exchange: The exchange name consists of a non-empty.
-            :param str routing_key: The routing key to bind on.
-            :param float timeout: if waiting the result over timeount seconds,
-                                  RemoteCallTimeout will be raised .
-            """
-            ignore_result = kwargs.pop('ignore_result', False)
-            exchange = kwargs.pop('exchange', self._exchange)
-            routing_key = kwargs.pop('routing_key', self._exchange)
-            timeout = kwargs.pop('timeout', None)
-
-            if not ignore_result:
-                self.setup_callback_queue()
+        """
+        try:
+            stub = self._stubs[consumer_name]
+        except KeyError:
+            stub = self._stubs[consumer_name] = make_stub(consumer_name)
+
+        # Cache the plain function and bind it per access, a cached bound
+        # stub would keep the client alive and its connection open.
+        return types.MethodType(stub, self)
 
+    def proxy(self, consumers):
+        """Return an object exposing the given consumers as methods.
+
+        :param consumers: Consumer names, or Consumer objects whose consume
+                          function lends its signature and docstring.
+        """
+        return ConsumerProxy(self, consumers)
+
+    def __getattr__(self, key):
+        if not key.startswith('call_'):
+            raise AttributeError(key)
+
+        return self.call(key[len('call_'):])
+
+    def __del__(self):
+        if self.connection.is_open:
+            self.connection.close()
+
+
+def make_stub(consumer_name):
+    """Return the function calling the remote consumer, it takes the client
+    as its first argument.
+
+    """
+
+    def func(self, *args, **kwargs):
+        """Call the remote function.
+
+        :param bool ignore_result: Ignore the result return immediately.
+        :param str exchange: The exchange name consists of a non-empty.
+        :param str routing_key: The routing key to bind on.
+        :param float timeout: if waiting the result over timeount seconds,
+                              RemoteCallTimeout will be raised .
+        :param int priority: The AMQP message priority (0-255), only
+                             takes effect on queues declared with
+                             ``x-max-priority``.
+        :param bool hedge: Send a duplicate call if no response arrives
+                           within the recent p95 latency, only use it
+                           for idempotent consumers.
+        :param str idempotency_key: Workers with an idempotency store run
+                                    the call until it succeeds once per
+                                    key and answer retries with the
+                                    stored result.
+        """
+        ignore_result = kwargs.pop('ignore_result', False)
+        exchange = kwargs.pop('exchange', self._exchange)
+        routing_key = kwargs.pop('routing_key', self._exchange)
+        timeout = kwargs.pop('timeout', None)
+        priority = kwargs.pop('priority', None)
+        hedge = kwargs.pop('hedge', False)
+        idempotency_key = kwargs.pop('idempotency_key', None)
+
+        try:
+            if timeout is not None:
+                timeout = float(timeout)
+        except (ValueError, TypeError):
+            raise ValueError("'timeout' is expected a float.")
+
+        if priority is not None:
             try:
-                if timeout is not None:
-                    timeout = float(timeout)
+                priority = int(priority)
             except (ValueError, TypeError):
-                raise ValueError("'timeout' is expected a float.")
+                raise ValueError("'priority' is expected an integer.")
+
+            if not 0 <= priority <= 255:
+                raise ValueError("'priority' must be between 0 and 255.")
 
-            payload = {
-                'args': args,
-                'kwargs': kwargs,
-            }
+        payload = {
+            'args': args,
+            'kwargs': kwargs,
+        }
 
-            corr_id = self.publish_message(
+        breaker = None if ignore_result else self.get_breaker(consumer_name)
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(
+                "Circuit of remote function '%s' is open." % consumer_name)
+
+        headers = {'consumer_name': consumer_name}
+        if idempotency_key is not None:
+            headers[IDEMPOTENCY_KEY] = str(idempotency_key)
+
+        def send():
+            return self.publish_message(
                 exchange,
                 routing_key,
                 body=payload,
-                headers={'consumer_name': consumer_name})
-
-            logger.info('Sent remote call: %s', consumer_name)
-            if not ignore_result:
-                try:
-                    ret = self.get_response(corr_id, timeout)
-                except RemoteCallTimeout:
-                    raise RemoteCallTimeout(
-                        "Calling remote function '%s' timeout." % consumer_name)
-
-                if isinstance(ret, RemoteFunctionError):
-                    raise ret
+                headers=headers,
+                priority=priority,
+                reply=not ignore_result)
 
-                return ret
+        started = time.time()
+        self._last_trace = None
 
+        if ignore_result:
+            corr_id = send()
+            logger.info('Sent remote call: %s', consumer_name)
             self.skip_response(corr_id)
+            return
 
-        func.__name__ = consumer_name
-        return func
-
-    def __getattribute__(self, key):
-        if key.startswith('call_'):
-            _, consumer_name = key.split('call_')
-            return self.call(consumer_name)
-
-        return super(RPCClient, self).__getattribute__(key)
-
-    def __del__(self):
-        self.connection.close()
+        try:
+            # Publishing may fail too, the outcome must still be recorded
+            # or a half-open breaker would wait for its probe forever.
+            corr_id = send()
+            logger.info('Sent remote call: %s', consumer_name)
+            hedge_delay = (self.get_hedge_delay(consumer_name)
+                           if hedge else None)
+            ret = self.get_response(
+                corr_id, timeout,
+                hedge=send if hedge_delay is not None else None,
+                hedge_delay=hedge_delay)
+        except Exception as ex:
+            if breaker is not None:
+                breaker.record_failure()
+            if isinstance(ex, RemoteCallTimeout):
+                raise RemoteCallTimeout(
+                    "Calling remote function '%s' timeout." % consumer_name)
+            raise
+
+        if isinstance(ret, RemoteFunctionError):
+            if breaker is not None:
+                breaker.record_failure()
+            raise ret
+
+        if breaker is not None:
+            breaker.record_success()
+        latency = time.time() - started
+        self.record_latency(consumer_name, latency)
+        if self._last_trace is not None:
+            self.export_span(consumer_name, int(latency * 1000000))
+        return ret
+
+    func.__name__ = consumer_name
+    return func
+
+
+class ConsumerProxy(object):
+    """Calling a known set of remote consumers as plain methods, mistyped
+    names raise AttributeError instead of silently becoming remote calls.
+
+    """
+
+    def __init__(self, client, consumers):
+        self._client = client
+        self._names = []
+
+        for c in consumers:
+            name = getattr(c, 'name', c)
+            stub = client.call(name)
+            consume = getattr(c, 'consume', None)
+            if consume is not None:
+                stub = wrap_stub(stub, consume)
+
+            setattr(self, name, stub)
+            self._names.append(name)
+
+    def __dir__(self):
+        return list(self._names)
+
+    def __repr__(self):
+        return '<ConsumerProxy: %s>' % ', '.join(self._names)
+
+
+def wrap_stub(stub, consume):
+    """Return a function calling the stub, documented like consume."""
+
+    def func(*args, **kwargs):
+        return stub(*args, **kwargs)
+
+    func.__name__ = stub.__name__
+    func.__doc__ = consume.__doc__
+    func.__wrapped__ = consume
+    return func
@@ -1,22 +1,39 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import atexit
 import importlib
-import imp
 import logging
 import os
+import signal
 import sys
+import threading
+import time
 import traceback
+import types
 
 import pika
 
-from rabbit_rpc.consumer import Consumer
+from rabbit_rpc.consumer import OVERLOAD_PAUSE, OVERLOAD_POLICIES
 from rabbit_rpc.credentials import AliyunCredentialsProvider
+from rabbit_rpc.idempotency import MemoryStore
+from rabbit_rpc.manifest import collect_consumers, dump_manifest, load_manifest
+from rabbit_rpc.profiling import MODE_CPROFILE, PROFILE_MODES, ConsumerProfiler
 from rabbit_rpc.server import RPCServer
+from rabbit_rpc.shm import SharedMemoryTransport
+from rabbit_rpc.tracing import LoggingExporter
 from .base import BaseCommand
 
+try:
+    from importlib.util import find_spec
+except ImportError:  # Python 2
+    import imp
+    find_spec = None
+
 logger = logging.getLogger(__name__)
 
+ENTRY_POINT_GROUP = 'rabbit_rpc.consumers'
+
 
 class Worker(BaseCommand):
 
@@ -40,6 +57,87 @@ class Worker(BaseCommand):
 
             [access_key]:[access_secret]:[resource_owner_id]
             ''')
+        parser.add_argument(
+            '--workers', type=int,
+            help='the number of threads running consumers')
+        parser.add_argument(
+            '--max-priority', type=int,
+            help='declare queues with x-max-priority (1-255), existing '
+                 'queues must be deleted first')
+        parser.add_argument(
+            '--priority-workers', type=int, default=0,
+            help='the number of threads reserved for high-priority messages')
+        parser.add_argument(
+            '--priority-threshold', type=int, default=1,
+            help='the lowest message priority served by the reserved threads')
+        parser.add_argument(
+            '--max-pending', type=int,
+            help='the number of unfinished messages over which a queue is '
+                 'overloaded')
+        parser.add_argument(
+            '--overload-policy', default=OVERLOAD_PAUSE,
+            choices=OVERLOAD_POLICIES,
+            help='what to do with messages delivered while overloaded: pause '
+                 'consuming, requeue them for other workers and pause, or '
+                 'reply with an overloaded error')
+        parser.add_argument(
+            '--prefetch', type=int,
+            help='the number of unacked messages delivered to each queue, '
+                 'it must exceed --max-pending (default: twice --max-pending '
+                 'or 10)')
+        parser.add_argument(
+            '--drain-timeout', type=float, default=30.0,
+            help='seconds to wait for in-flight messages on SIGTERM')
+        parser.add_argument(
+            '--trace', action='store_true',
+            help='log a timing span for every traced call')
+        parser.add_argument(
+            '--profile-consumers', metavar='NAME[,NAME...]',
+            help='profile a sample of the calls of these consumers')
+        parser.add_argument(
+            '--profile-sample-rate', type=float, default=0.01,
+            help='the fraction of calls profiled')
+        parser.add_argument(
+            '--profile-mode', default=MODE_CPROFILE, choices=PROFILE_MODES,
+            help='cProfile into pstats files, or sample wall-clock stacks '
+                 'into collapsed-stack files')
+        parser.add_argument(
+            '--profile-dir', default='.',
+            help='where the profiles are dumped, also on SIGUSR1')
+        parser.add_argument(
+            '--profile-interval', type=float,
+            help='dump the profiles every interval seconds')
+        parser.add_argument(
+            '--idempotency-cache', type=int, default=0, metavar='SIZE',
+            help='remember the results of up to SIZE successful calls with '
+                 'an idempotency key and answer their duplicates from it')
+        parser.add_argument(
+            '--idempotency-ttl', type=float, default=3600.0,
+            help='seconds the replies are remembered')
+        parser.add_argument(
+            '--shm-threshold', type=int, metavar='BYTES',
+            help='pass arguments and results of at least BYTES through '
+                 'shared memory with clients on the same host, running as '
+                 'the same user')
+        parser.add_argument(
+            '--shm-dir', help='the shared memory directory, /dev/shm by '
+                              'default')
+        parser.add_argument(
+            '--shm-max-age', type=float, default=600.0,
+            help='seconds after which unread payloads are removed, it must '
+                 'exceed the longest time calls wait in the queue')
+        parser.add_argument(
+            '--consumers', action='append', metavar='MODULE',
+            help='import consumers from the module, can be given repeatedly')
+        parser.add_argument(
+            '--manifest',
+            help='cache consumer locations in the file and import consumers '
+                 'lazily on their first call, it is rebuilt when a consumer '
+                 'module changes')
+        parser.add_argument(
+            '--rebuild-manifest', action='store_true',
+            help='discover consumers again and rewrite the manifest, e.g. '
+                 'after adding a consumer module')
 
     def install_django(self, project_name):
         import django
@@ -47,23 +145,60 @@ class Worker(BaseCommand):
         os.environ['DJANGO_SETTINGS_MODULE'] = project_name + '.settings'
         django.setup()
 
+    def install_profiler(self, options):
+        if not options.get('profile_consumers'):
+            return None
+
+        profiler = ConsumerProfiler(
+            options['profile_consumers'].split(','),
+            sample_rate=options['profile_sample_rate'],
+            mode=options['profile_mode'],
+            output_dir=options['profile_dir'],
+            interval=options['profile_interval'])
+
+        # Don't write files inside the signal handler, it interrupts the
+        # IOLoop thread.
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, frame: threading.Thread(target=profiler.dump).start())
+        atexit.register(profiler.dump)
+        return profiler
+
     def parse_aliyun_cert(self, raw_cert):
         try:
             access_key, access_secret, resource_owner_id = raw_cert.split(':')
         except ValueError:
             raise ValueError('invalid alicert')
 
-        provider = AliyunCredentialsProvider(
+        return AliyunCredentialsProvider(
             access_key, access_secret, resource_owner_id)
 
-        return provider.get_username(), provider.get_password()
+    def find_consumers(self, modules=None, related_name='consumers'):
+        """Return ``(module_name, attr, consumer)`` tuples of the consumers
+        in the given modules, or else in the modules registered under the
+        ``rabbit_rpc.consumers`` entry point group, or else in the
+        ``consumers`` module of every package in the current directory.
 
-    def find_consumers(self, related_name='consumers'):
-        path = os.getcwd()
+        """
         logger.info('Finding consumers...')
 
-        consumers = []
-        for dirpath in os.listdir(path):
+        if modules:
+            found = [importlib.import_module(m) for m in modules]
+        else:
+            found = find_entry_point_modules() or self.scan_packages(
+                related_name)
+
+        locations = []
+        for module in found:
+            for attr, c in collect_consumers(module):
+                logger.info('[Consumer] %s.%s', module.__name__, c.name)
+                locations.append((module.__name__, attr, c))
+
+        return locations
+
+    def scan_packages(self, related_name):
+        modules = []
+        for dirpath in os.listdir(os.getcwd()):
             if dirpath.startswith('.'):
                 continue
 
@@ -71,19 +206,48 @@ class Worker(BaseCommand):
                 try:
                     module = find_related_module(dirpath, related_name)
                     if module:
-                        for item in dir(module):
-                            c = getattr(module, item)
-                            if isinstance(c, Consumer):
-                                logger.info('[Consumer] %s.%s.%s', dirpath,
-                                            related_name, c.name)
-                                consumers.append(c)
+                        modules.append(module)
                 except ImportError:
                     pass
 
-        return consumers
+        return modules
+
+    def load_consumers(self, options):
+        manifest = options.get('manifest')
+        if manifest and not options.get('rebuild_manifest'):
+            consumers = load_manifest(manifest, options.get('consumers'))
+            if consumers:
+                logger.info('Loaded %d consumers from manifest %s',
+                            len(consumers), manifest)
+                return consumers
+
+        locations = self.find_consumers(options.get('consumers'))
+        if manifest and locations:
+            dump_manifest(manifest, locations, options.get('consumers'))
+            logger.info('Wrote consumer manifest %s', manifest)
+
+        return [c for _, _, c in locations]
+
+    def get_prefetch_count(self, options):
+        max_pending = options['max_pending']
+        prefetch = options['prefetch']
+        if prefetch is None:
+            return 2 * max_pending if max_pending else 10
+
+        # An overload is only seen with more messages delivered than
+        # max_pending, 0 is unlimited.
+        if max_pending is not None and 0 < prefetch <= max_pending:
+            self.arg_parser.error('--prefetch must exceed --max-pending')
+
+        return prefetch
 
     def execute(self, **options):
+        started_at = time.time()
         sys.path.append(os.getcwd())
+        prefetch_count = self.get_prefetch_count(options)
+        max_priority = options['max_priority']
+        if max_priority is not None and not 1 <= max_priority <= 255:
+            self.arg_parser.error('--max-priority must be between 1 and 255')
 
         try:
             conn_parameters = pika.URLParameters(options['amqp'])
@@ -91,20 +255,57 @@ class Worker(BaseCommand):
             if options.get('django'):
                 self.install_django(options['django'])
 
+            credentials_provider = None
             if options.get('alicert'):
-                username, password = self.parse_aliyun_cert(options['alicert'])
-                conn_parameters.credentials = pika.PlainCredentials(
-                    username, password, erase_on_connect=True)
+                credentials_provider = self.parse_aliyun_cert(
+                    options['alicert'])
 
-            consumers = self.find_consumers()
+            consumers = self.load_consumers(options)
             if not consumers:
                 sys.stderr.write('No consumer was detected.\n')
                 sys.exit(1)
 
+            logger.info('Found %d consumers in %.3fs', len(consumers),
+                        time.time() - started_at)
+
+            dispatcher_options = {
+                'max_workers': options['workers'],
+                'priority_workers': options['priority_workers'],
+                'priority_threshold': options['priority_threshold'],
+                'max_pending': options['max_pending'],
+                'overload_policy': options['overload_policy'],
+            }
+            if options['trace']:
+                dispatcher_options['exporter'] = LoggingExporter()
+
+            if options['idempotency_cache']:
+                dispatcher_options['idempotency_store'] = MemoryStore(
+                    options['idempotency_cache'], options['idempotency_ttl'])
+
+            if options['shm_threshold'] is not None:
+                dispatcher_options['shm'] = SharedMemoryTransport(
+                    options['shm_threshold'], options['shm_dir'],
+                    options['shm_max_age'])
+
+            profiler = self.install_profiler(options)
+            if profiler is not None:
+                dispatcher_options['profiler'] = profiler
+
             server = RPCServer(
                 consumers, conn_parameters=conn_parameters,
-                queue=options['queue'])
+                queue=options['queue'],
+                max_priority=options['max_priority'],
+                dispatcher_options=dispatcher_options,
+                started_at=started_at,
+                credentials_provider=credentials_provider,
+                drain_timeout=options['drain_timeout'],
+                prefetch_count=prefetch_count)
+
+            signal.signal(signal.SIGTERM,
+                          lambda signum, frame: server.request_drain())
             server.run()
+            if server.fatal_error is not None:
+                sys.exit(1)
         except KeyboardInterrupt:
             server.stop()
         except Exception:
@@ -129,9 +330,44 @@ def find_related_module(package, related_name):
     if not isinstance(pkg_path, list):
         pkg_path = pkg_path._path
 
+    module_name = '{0}.{1}'.format(package, related_name)
+    if find_spec is not None:
+        if find_spec(module_name) is None:
+            return
+    else:
+        try:
+            imp.find_module(related_name, pkg_path)
+        except ImportError:
+            return
+
+    return importlib.import_module(module_name)
+
+
+def find_entry_point_modules(group=ENTRY_POINT_GROUP):
+    """Import the consumer modules registered by installed distributions,
+    e.g. ``entry_points={'rabbit_rpc.consumers': ['app = app.consumers']}``.
+
+    """
     try:
-        imp.find_module(related_name, pkg_path)
-    except ImportError as e:
-        return
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            from pkg_resources import iter_entry_points
+        except ImportError:
+            return []
+        eps = iter_entry_points(group)
+    else:
+        eps = entry_points()
+        eps = eps.select(group=group) if hasattr(eps, 'select') else \
+            eps.get(group, [])
+
+    modules = []
+    for ep in eps:
+        module = ep.load()
+        if not isinstance(module, types.ModuleType):
+            logger.warning('Entry point %s should refer to a module.', ep.name)
+            continue
+
+        modules.append(module)
 
-    return importlib.import_module('{0}.{1}'.format(package, related_name))
+    return modules
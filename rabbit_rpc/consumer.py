@@ -1,15 +1,34 @@
 # -*- coding: utf-8 -*-
+import importlib
 import logging
 import json
+from threading import Lock
 
 import pika
 from concurrent.futures import ThreadPoolExecutor
 from six import python_2_unicode_compatible
 
-from .exceptions import ERROR_FLAG, HAS_ERROR, NO_ERROR
+from .exceptions import (ERROR_FLAG, HAS_ERROR, NO_ERROR, OVERLOADED,
+                         PayloadUnavailable)
+from .idempotency import IDEMPOTENCY_KEY
+from .shm import SHM_ACCEPT, SHM_HEADER
+from .tracing import (NOOP_EXPORTER, REPLIED_AT, SENT_AT, SPAN_ID, TIMING,
+                      TRACE_ID, Span, new_id, now_us, set_current_trace_id)
 
 logger = logging.getLogger(__name__)
 
+# What the dispatcher does with a delivery once max_pending is reached.
+OVERLOAD_PAUSE = 'pause'
+OVERLOAD_REQUEUE = 'requeue'
+OVERLOAD_REPLY = 'reply'
+OVERLOAD_POLICIES = (OVERLOAD_PAUSE, OVERLOAD_REQUEUE, OVERLOAD_REPLY)
+
+# Reply headers are never mutated, so share them between replies.
+_REPLY_HEADERS = {
+    False: {ERROR_FLAG: NO_ERROR},
+    True: {ERROR_FLAG: HAS_ERROR},
+}
+
 
 @python_2_unicode_compatible
 class Consumer(object):
@@ -29,6 +48,35 @@ class Consumer(object):
         return '<%s.Consumer: %s>' % (self.__module__, self.name)
 
 
+class LazyConsumer(Consumer):
+    """A consumer known by its location, the module defining it is only
+    imported on the first call.
+
+    """
+
+    def __init__(self, name, module, attr, queue=None, exclusive=False):
+        super(LazyConsumer, self).__init__(name, queue, exclusive)
+        self.module = module
+        self.attr = attr
+
+        self._lock = Lock()
+        self._consumer = None
+
+    def load(self):
+        if self._consumer is None:
+            with self._lock:
+                if self._consumer is None:
+                    module = importlib.import_module(self.module)
+                    self._consumer = getattr(module, self.attr)
+                    logger.info('[Consumer] %s.%s loaded', self.module,
+                                self.attr)
+
+        return self._consumer
+
+    def consume(self, *args, **kwargs):
+        return self.load().consume(*args, **kwargs)
+
+
 def consumer(name=None, queue=None, exclusive=False):
 
     def decorator(func):
@@ -41,20 +89,87 @@ def consumer(name=None, queue=None, exclusive=False):
     return decorator
 
 
+class ConsumerHandler(object):
+    """The dispatch table entry of a registered consumer."""
+
+    __slots__ = ('consumer', 'name', 'consume')
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.name = consumer.name
+        self.consume = consumer.consume
+
+    def __repr__(self):
+        return '<ConsumerHandler: %s>' % self.name
+
+
 class MessageDispatcher(object):
 
-    def __init__(self, channel, exchange=''):
+    def __init__(self, channel, exchange='', max_workers=None,
+                 priority_workers=0, priority_threshold=1, max_pending=None,
+                 overload_policy=OVERLOAD_PAUSE, exporter=None,
+                 profiler=None, idempotency_store=None, shm=None):
+        """
+        :param int max_workers: The size of the executor running consumers.
+        :param int priority_workers: The size of a dedicated executor reserved
+                                     for high-priority messages. 0 disables it.
+        :param int priority_threshold: Messages with an AMQP priority greater
+                                       than or equal to it are high-priority.
+        :param int max_pending: The number of admitted but unfinished messages
+                                over which the dispatcher is overloaded.
+                                None means unbounded.
+        :param str overload_policy: One of ``pause`` (cancel the consumer
+                                    until the backlog drains), ``requeue``
+                                    (reject the message back to RabbitMQ for
+                                    other workers, and pause) or ``reply``
+                                    (answer with an overloaded error).
+                                    The consumer prefetch count must exceed
+                                    max_pending for them to take effect.
+        :param Exporter exporter: Receives a span for every traced call.
+        :param ConsumerProfiler profiler: Profiles a sample of the calls.
+        :param IdempotencyStore idempotency_store: Remembers the replies of
+                                                   calls with an idempotency
+                                                   key, duplicates are
+                                                   answered from it.
+        :param SharedMemoryTransport shm: Reads large arguments from and
+                                          writes large results to shared
+                                          memory for co-located clients.
+        """
+        if overload_policy not in OVERLOAD_POLICIES:
+            raise ValueError('Unknown overload policy: %s' % overload_policy)
+
         self._channel = channel
 
         self._registries = {}
-        self._executor = ThreadPoolExecutor()
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._priority_executor = None
+        if priority_workers:
+            self._priority_executor = ThreadPoolExecutor(priority_workers)
+        self._priority_threshold = priority_threshold
         self._exchange = exchange
 
+        self._lock = Lock()
+        self._pending = 0
+        self._paused = False
+        self._cancelled = False
+        self.max_pending = max_pending
+        self.overload_policy = overload_policy
+        self.metrics = {'accepted': 0, 'rejected': 0, 'paused': 0,
+                        'duplicates': 0}
+        self._exporter = exporter or NOOP_EXPORTER
+        self._profiler = profiler
+        self._idempotency_store = idempotency_store
+        self._shm = shm
+        # idempotency key => (delivery_tag, properties) of the duplicates
+        # delivered while the first call is running
+        self._running_keys = {}
+
+        self.queue_name = None
         self.consumer_tag = None
 
     def register(self, consumer):
         if consumer.name not in self._registries:
-            self._registries[consumer.name] = consumer
+            self._registries[consumer.name] = ConsumerHandler(consumer)
 
     def __call__(self, *args, **kwargs):
         return self.dispatch_message(*args, **kwargs)
@@ -62,6 +177,99 @@ class MessageDispatcher(object):
     def clear(self):
         self._registries = {}
 
+    def consume(self, queue_name):
+        """Start consuming messages from the queue."""
+        self.queue_name = queue_name
+        self.consumer_tag = self._channel.basic_consume(queue_name, self)
+
+    def pause(self):
+        """Stop RabbitMQ delivering messages until the backlog drains."""
+        if self._paused or self.consumer_tag is None:
+            return
+
+        logger.warning('Dispatcher of queue %s is overloaded, pause consuming.',
+                       self.queue_name)
+        with self._lock:
+            self._paused = True
+            # The backlog may have drained before release() saw the pause.
+            drained = self._pending <= self.max_pending // 2
+        self.metrics['paused'] += 1
+        self._channel.basic_cancel(self.consumer_tag)
+
+        if drained:
+            self.resume()
+
+    def resume(self):
+        """Invoked on the IOLoop thread once the backlog has drained."""
+        if not self._paused or self._cancelled:
+            return
+
+        logger.info('Dispatcher of queue %s resume consuming.', self.queue_name)
+        self._paused = False
+        self.consume(self.queue_name)
+
+    def cancel(self):
+        """Stop consuming for good, messages already delivered are still
+        run, replied and acknowledged.
+
+        """
+        if self._cancelled:
+            return
+
+        self._cancelled = True
+        if self.consumer_tag is not None and not self._paused:
+            self._channel.basic_cancel(self.consumer_tag)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def admit(self, delivery_tag, properties, urgent=False):
+        """Decide whether the delivered message may be submitted to the
+        executor. Returns False if the message has been shed according to
+        the overload policy.
+
+        """
+        with self._lock:
+            overloaded = (self.max_pending is not None and
+                          self._pending >= self.max_pending)
+            if not overloaded or urgent or \
+                    self.overload_policy == OVERLOAD_PAUSE:
+                self._pending += 1
+                self.metrics['accepted'] += 1
+            else:
+                self.metrics['rejected'] += 1
+
+        if not overloaded or urgent:
+            return True
+
+        if self.overload_policy == OVERLOAD_PAUSE:
+            # The message is already delivered, run it anyway.
+            self.pause()
+            return True
+
+        if self.overload_policy == OVERLOAD_REQUEUE:
+            self._channel.basic_reject(delivery_tag, requeue=True)
+            # Or the message comes straight back to be rejected again.
+            self.pause()
+        else:
+            if properties.reply_to:
+                self.reply_message(properties, 'Server is overloaded.',
+                                   headers={ERROR_FLAG: OVERLOADED})
+            self.acknowledge_message(delivery_tag, properties)
+
+        return False
+
+    def release(self):
+        """Invoked by executor threads when an admitted message is done."""
+        with self._lock:
+            self._pending -= 1
+            drained = self._paused and self._pending <= self.max_pending // 2
+
+        if drained:
+            self._channel.connection.ioloop.add_callback_threadsafe(
+                self.resume)
+
     def dispatch_message(self, channel, basic_deliver, properties, body):
         """Invoked by pika when a message is delivered from RabbitMQ. The
         channel is passed for your convenience. The basic_deliver object that
@@ -76,33 +284,182 @@ class MessageDispatcher(object):
         :param str|unicode body: The message body
 
         """
-        consumer_name = properties.headers.get('consumer_name')
-
-        logger.info("Received a remote call on function '%s'", consumer_name)
-
         try:
-            consumer = self._registries[consumer_name]
-        except KeyError:
+            handler = self._registries[properties.headers['consumer_name']]
+        except (KeyError, TypeError):
+            consumer_name = (properties.headers or {}).get('consumer_name')
             msg = "Function '%s' not found." % consumer_name
             logger.info(msg)
             if properties.reply_to:
                 self.reply_message(
                     properties, msg, is_error=True)
 
-            self.acknowledge_message(basic_deliver.delivery_tag)
+            self.acknowledge_message(basic_deliver.delivery_tag, properties)
+            return
+
+        executor = self.select_executor(properties)
+        urgent = executor is self._priority_executor
+        if not self.admit(basic_deliver.delivery_tag, properties, urgent):
+            return
+
+        try:
+            submitted = self.submit_message(executor, handler,
+                                            basic_deliver.delivery_tag,
+                                            properties, body)
+        except Exception:
+            self.release()
+            raise
+
+        if not submitted:
+            self.release()
+
+    def submit_message(self, executor, handler, delivery_tag, properties,
+                       body):
+        """Submit an admitted message to the executor. Returns False if it
+        was answered without running the consumer.
+
+        """
+        if self._idempotency_store is not None and self.answer_duplicate(
+                delivery_tag, properties):
+            return False
+
+        logger.debug("Received a remote call on function '%s'", handler.name)
+
+        # Only calls sent by a tracing client are timed.
+        received_at = now_us() if TRACE_ID in properties.headers else None
+
+        try:
+            args, kwargs = self.decode_message(properties, body)
+        except Exception as ex:
+            # A malformed message must not escape into the IOLoop.
+            msg = "Invalid call on function '%s': %s" % (handler.name, ex)
+            logger.warning(msg)
+            if properties.reply_to:
+                self.reply_message(properties, msg, is_error=True)
+            self.acknowledge_message(delivery_tag, properties)
+            if self._idempotency_store is not None:
+                self.remember(properties, msg, is_error=True)
+            return False
+
+        try:
+            executor.submit(self.call_comsumer, handler, delivery_tag,
+                            properties, args, kwargs, received_at)
+        except Exception as ex:
+            # The call won't run, don't leave its duplicates waiting on it.
+            if self._idempotency_store is not None:
+                self.remember(properties, str(ex), is_error=True)
+            raise
+
+        return True
+
+    def decode_message(self, properties, body):
+        """Return the call arguments, reading the body from shared memory
+        if the client put it there.
+
+        """
+        if SHM_HEADER in properties.headers:
+            if self._shm is None:
+                raise PayloadUnavailable(
+                    'shared memory payloads are not enabled on this worker')
+            body = self._shm.load(properties.headers, body)
+
+        return decode_arguments(body)
+
+    def answer_duplicate(self, delivery_tag, properties):
+        """Answer the call from the idempotency store if its key was seen
+        before, or queue it behind the running call with the same key.
+        Returns False if the call should run.
+
+        """
+        key = idempotency_key(properties)
+        if key is None:
+            return False
+
+        if self.wait_running(key, delivery_tag, properties):
+            return True
+
+        # The store may be remote, don't hold the lock while querying it.
+        cached = self._idempotency_store.get(key)
+        if cached is None:
+            # A call with the same key may have started meanwhile.
+            return self.wait_running(key, delivery_tag, properties,
+                                     start=True)
+
+        with self._lock:
+            self.metrics['duplicates'] += 1
+
+        logger.info("Answer duplicate call '%s' from the idempotency store",
+                    key)
+        ret, is_error = cached
+        if properties.reply_to:
+            self.reply_message(properties, ret, is_error=is_error)
+        self.acknowledge_message(delivery_tag, properties)
+        return True
+
+    def wait_running(self, key, delivery_tag, properties, start=False):
+        """Queue the call behind the running call with the same key, or
+        mark it as running if start is True. Returns True if it was queued.
+
+        """
+        with self._lock:
+            waiters = self._running_keys.get(key)
+            if waiters is None:
+                if start:
+                    self._running_keys[key] = []
+                return False
+
+            waiters.append((delivery_tag, properties))
+            self.metrics['duplicates'] += 1
+            return True
+
+    def remember(self, props, ret, is_error):
+        """Store the result of a successful call with an idempotency key and
+        answer the duplicates delivered meanwhile.
+
+        """
+        key = idempotency_key(props)
+        if key is None:
             return
 
-        arguments = json.loads(body)
-        args = arguments.get('args', [])
-        kwargs = arguments.get('kwargs', {})
-        self._executor.submit(self.call_comsumer, consumer,
-                              basic_deliver.delivery_tag, properties, *args, **kwargs)
+        # Failed calls are not stored, a retry runs them again.
+        if not is_error:
+            try:
+                self._idempotency_store.set(key, (ret, is_error))
+            except Exception:
+                logger.exception('Failed to store idempotency key %s', key)
+
+        with self._lock:
+            waiters = self._running_keys.pop(key, ())
+
+        for delivery_tag, properties in waiters:
+            if properties.reply_to:
+                self.reply_message(properties, ret, is_error=is_error)
+            self.acknowledge_message(delivery_tag, properties)
+
+    def select_executor(self, properties):
+        """Return the executor for the message, high-priority messages go to
+        the reserved executor so they skip ahead of the local backlog.
+
+        """
+        if (self._priority_executor is not None and
+                properties.priority is not None and
+                properties.priority >= self._priority_threshold):
+            return self._priority_executor
+
+        return self._executor
 
     def reply_message(self, props, body, headers=None, is_error=False):
-        if headers is None:
-            headers = {}
+        body = json.dumps(body)
+        if (self._shm is not None and len(body) >= self._shm.threshold and
+                props.headers and props.headers.get(SHM_ACCEPT)):
+            headers = dict(headers or {})
+            body = self._shm.dump(body, headers)
 
-        headers[ERROR_FLAG] = NO_ERROR if not is_error else HAS_ERROR
+        if headers is None:
+            headers = _REPLY_HEADERS[is_error]
+        else:
+            headers.setdefault(
+                ERROR_FLAG, NO_ERROR if not is_error else HAS_ERROR)
 
         self._channel.basic_publish(
             exchange=self._exchange,
@@ -110,29 +467,118 @@ class MessageDispatcher(object):
             properties=pika.BasicProperties(
                 correlation_id=props.correlation_id,
                 headers=headers),
-            body=json.dumps(body))
+            body=body)
+
+    def call_comsumer(self, handler, delivery_tag, props, args, kwargs,
+                      received_at=None):
+        """Run the consumer on an executor thread, then reply and ack.
+
+        :param ConsumerHandler handler: The dispatch table entry
+        :param list args: The decoded positional arguments
+        :param dict kwargs: The decoded keyword arguments
+        :param int received_at: The delivery time in microseconds of a
+                                traced call, None if it is not traced.
+
+        """
+        try:
+            if received_at is not None:
+                return self.call_traced(handler, delivery_tag, props, args,
+                                        kwargs, received_at)
+
+            ret, is_error = self.run_consumer(handler, props, args, kwargs)
+            if props.reply_to is not None:
+                self.reply_message(props, ret, is_error=is_error)
+
+            self.acknowledge_message(delivery_tag, props)
+        finally:
+            self.release()
+
+    def call_traced(self, handler, delivery_tag, props, args, kwargs,
+                    received_at):
+        """Like call_comsumer, and return the timing breakdown in the reply
+        headers.
+
+        """
+        headers = props.headers
+        trace_id = headers[TRACE_ID]
+        parent_id = headers.get(SPAN_ID)
 
-    def call_comsumer(self, consumer, delivery_tag, props, *args, **kwargs):
+        started_at = now_us()
+        set_current_trace_id(trace_id)
         try:
-            ret = consumer.consume(*args, **kwargs)
-            is_error = False
+            ret, is_error = self.run_consumer(handler, props, args, kwargs)
+        finally:
+            set_current_trace_id(None)
+        finished_at = now_us()
+
+        timing = {
+            'broker_wait': received_at - headers.get(SENT_AT, received_at),
+            'queue_wait': started_at - received_at,
+            'execute': finished_at - started_at,
+        }
+
+        if props.reply_to is not None:
+            self.reply_message(props, ret, is_error=is_error, headers={
+                TRACE_ID: trace_id,
+                SPAN_ID: parent_id,
+                TIMING: timing,
+                REPLIED_AT: now_us(),
+            })
+
+        self.acknowledge_message(delivery_tag, props)
+
+        if self._exporter.enabled:
+            timing = dict(timing, reply=now_us() - finished_at)
+            self._exporter.export(Span(trace_id, new_id(), handler.name,
+                                       'server', timing, parent_id))
+
+    def run_consumer(self, handler, props, args, kwargs):
+        """Return the result of the consumer and whether it failed."""
+        consume = handler.consume
+        if self._profiler is not None:
+            consume = self._profiler.wrap(handler.name, consume)
+
+        try:
+            ret, is_error = consume(*args, **kwargs), False
         except Exception as ex:
             logger.exception(
-                'Error occurred when calling consumer. consumer: %s, args: %s, '
-                'kwargs: %s', consumer.name, args, kwargs)
-            ret = str(ex)
-            is_error = True
+                'Error occurred when calling consumer. consumer: %s, '
+                'args: %s, kwargs: %s', handler.name, args, kwargs)
+            ret, is_error = str(ex), True
 
-        if props.reply_to is not None:
-            self.reply_message(props, ret, is_error=is_error)
+        if self._idempotency_store is not None:
+            self.remember(props, ret, is_error)
 
-        self.acknowledge_message(delivery_tag)
+        return ret, is_error
 
-    def acknowledge_message(self, delivery_tag):
+    def acknowledge_message(self, delivery_tag, properties=None):
         self._channel.basic_ack(delivery_tag)
+        # The message can't be redelivered anymore, drop its payload.
+        if self._shm is not None and properties is not None:
+            self._shm.discard(properties.headers)
 
     def __contains__(self, consumer_name):
         return consumer_name in self._registries
 
-    def stop(self):
-        self._executor.shutdown()
+    def stop(self, wait=True):
+        self._executor.shutdown(wait)
+        if self._priority_executor is not None:
+            self._priority_executor.shutdown(wait)
+
+
+def idempotency_key(properties):
+    """Return the idempotency key of the call scoped by its consumer, the
+    same key sent to different consumers names different calls.
+
+    """
+    key = properties.headers.get(IDEMPOTENCY_KEY)
+    if key is None:
+        return None
+
+    return '%s:%s' % (properties.headers['consumer_name'], key)
+
+
+def decode_arguments(body):
+    """Decode the message body into the call arguments."""
+    arguments = json.loads(body)
+    return arguments.get('args') or (), arguments.get('kwargs') or {}
@@ -4,6 +4,8 @@ import base64
 import time
 import hashlib
 
+import pika
+
 
 class AliyunCredentialsProvider:
     """
@@ -28,3 +30,16 @@ class AliyunCredentialsProvider:
         sig = h.hexdigest().upper()
         sig_str = "%s:%s" % (sig, ts)
         return base64.b64encode(sig_str.encode('utf-8'))
+
+
+def apply_credentials(conn_parameters, provider):
+    """Set fresh credentials from the provider on the connection parameters.
+    The provider should have ``get_username`` and ``get_password`` methods,
+    they are evaluated on every connect since signed passwords expire.
+
+    """
+    if provider is None:
+        return
+
+    conn_parameters.credentials = pika.PlainCredentials(
+        provider.get_username(), provider.get_password(), erase_on_connect=True)
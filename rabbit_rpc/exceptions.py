@@ -3,6 +3,7 @@
 ERROR_FLAG = 'error'
 NO_ERROR = 0
 HAS_ERROR = 1
+OVERLOADED = 2
 
 
 class RemoteFunctionError(Exception):
@@ -11,3 +12,19 @@ class RemoteFunctionError(Exception):
 
 class RemoteCallTimeout(Exception):
     pass
+
+
+class RemoteServerOverloaded(RemoteFunctionError):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class BrokerUnavailable(Exception):
+    pass
+
+
+class PayloadUnavailable(Exception):
+    pass
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+from threading import Lock
+
+IDEMPOTENCY_KEY = 'idempotency_key'
+
+
+class IdempotencyStore(object):
+    """Remembers the replies of calls by idempotency key, prefixed with the
+    consumer name as ``consumer:key``. Subclass it to share the replies
+    between workers or keep them across restarts, e.g. with redis. Stored
+    values are ``(result, is_error)`` pairs of JSON serializable data.
+
+    """
+
+    def get(self, key):
+        """Return the stored value, or None if it is unknown or expired."""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+
+class MemoryStore(IdempotencyStore):
+    """A bounded in-memory LRU store, entries expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize=10000, ttl=3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires_at, value = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            if expires_at < time.time():
+                return None
+
+            # Move it to the most recently used end.
+            self._entries[key] = (expires_at, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
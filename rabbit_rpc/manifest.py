@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import sys
+
+from .consumer import Consumer, LazyConsumer
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 2
+
+
+def collect_consumers(module):
+    """Return the ``(attr, consumer)`` pairs defined in the module."""
+    return [(attr, c) for attr, c in sorted(vars(module).items())
+            if isinstance(c, Consumer)]
+
+
+def source_file(module_name):
+    """Return the source file of an imported module, or None."""
+    path = getattr(sys.modules.get(module_name), '__file__', None)
+    if path and path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return path
+
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def dump_manifest(path, locations, modules=None):
+    """Write the consumer locations to the manifest file, along with what
+    tells whether it is still up to date.
+
+    :param str path: The manifest file path.
+    :param list locations: ``(module_name, attr, consumer)`` tuples.
+    :param list modules: The requested consumer modules, None if they were
+                         discovered.
+    """
+    sources = {}
+    for module_name, _, _ in locations:
+        source = source_file(module_name)
+        if source is not None:
+            sources[source] = get_mtime(source)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'modules': list(modules) if modules else None,
+        'sources': sources,
+        'consumers': [{
+            'name': c.name,
+            'module': module_name,
+            'attr': attr,
+            'queue': c.queue,
+            'exclusive': c.exclusive,
+        } for module_name, attr, c in locations],
+    }
+
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def load_manifest(path, modules=None):
+    """Return the lazily imported consumers listed in the manifest file, or
+    None if the manifest is missing or outdated: written for other requested
+    modules, or a consumer module changed since.
+
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        logger.info('Ignore outdated consumer manifest: %s', path)
+        return None
+
+    if manifest.get('modules') != (list(modules) if modules else None):
+        logger.info('Ignore consumer manifest of other modules: %s', path)
+        return None
+
+    for source, mtime in manifest.get('sources', {}).items():
+        if get_mtime(source) != mtime:
+            logger.info('Ignore stale consumer manifest: %s, %s changed',
+                        path, source)
+            return None
+
+    return [LazyConsumer(item['name'], item['module'], item['attr'],
+                         item.get('queue'), item.get('exclusive', False))
+            for item in manifest['consumers']]
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+logger = logging.getLogger(__name__)
+
+MODE_CPROFILE = 'cprofile'
+MODE_STACK = 'stack'
+PROFILE_MODES = (MODE_CPROFILE, MODE_STACK)
+
+
+class ConsumerProfiler(object):
+    """Profile a sample of the calls of some consumers.
+
+    In ``cprofile`` mode the sampled calls run under cProfile and are merged
+    into a pstats file per consumer, one call at a time: sampled calls
+    overlapping it run unprofiled. In ``stack`` mode a background thread
+    samples the wall-clock stacks of the threads running sampled calls and
+    writes them in collapsed-stack format, ready for flamegraph tools.
+
+    """
+
+    def __init__(self, consumers, sample_rate=0.01, mode=MODE_CPROFILE,
+                 output_dir='.', interval=None, stack_interval=0.005):
+        """
+        :param consumers: Names of the consumers to profile.
+        :param float sample_rate: The fraction of calls profiled.
+        :param str mode: ``cprofile`` or ``stack``.
+        :param str output_dir: Where the profiles are dumped.
+        :param float interval: Dump every interval seconds, None only dumps
+                               on demand.
+        :param float stack_interval: Seconds between stack samples.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError('Unknown profile mode: %s' % mode)
+
+        self.consumers = frozenset(consumers)
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.output_dir = output_dir
+        self.stack_interval = stack_interval
+
+        self._lock = threading.Lock()
+        # Only one cProfile session may be active per process on 3.12+.
+        self._cprofile_lock = threading.Lock()
+        self._stats = {}
+        self._stacks = defaultdict(Counter)
+        self._active = {}
+
+        if mode == MODE_STACK:
+            self._start_thread(self._sample_stacks)
+
+        if interval:
+            self._start_thread(self._dump_periodically, interval)
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def wrap(self, name, consume):
+        """Return consume itself, or a profiled version of it if the call is
+        sampled.
+
+        """
+        if name not in self.consumers or random.random() >= self.sample_rate:
+            return consume
+
+        if self.mode == MODE_CPROFILE:
+            return functools.partial(self._run_cprofile, name, consume)
+
+        return functools.partial(self._run_sampled, name, consume)
+
+    def _run_cprofile(self, name, consume, *args, **kwargs):
+        # Calls overlapping a profiled one run unprofiled, profiling must
+        # never change the outcome of a call.
+        if not self._cprofile_lock.acquire(False):
+            return consume(*args, **kwargs)
+
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiling tool is active.
+                return consume(*args, **kwargs)
+
+            try:
+                return consume(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._merge(name, profile)
+        finally:
+            self._cprofile_lock.release()
+
+    def _merge(self, name, profile):
+        try:
+            profile.create_stats()
+            if not profile.stats:
+                return
+
+            with self._lock:
+                if name in self._stats:
+                    self._stats[name].add(profile)
+                else:
+                    self._stats[name] = pstats.Stats(profile)
+        except Exception:
+            logger.exception('Failed to merge the profile of %s', name)
+
+    def _run_sampled(self, name, consume, *args, **kwargs):
+        thread_id = threading.current_thread().ident
+        self._active[thread_id] = name
+        try:
+            return consume(*args, **kwargs)
+        finally:
+            self._active.pop(thread_id, None)
+
+    def _sample_stacks(self):
+        while True:
+            time.sleep(self.stack_interval)
+            if not self._active:
+                continue
+
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, name in list(self._active.items()):
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        self._stacks[name][collapse_stack(frame)] += 1
+
+    def _dump_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            self.dump()
+
+    def dump(self):
+        """Write the profiles gathered so far, one file per consumer."""
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        pid = os.getpid()
+        with self._lock:
+            for name, stats in self._stats.items():
+                path = os.path.join(
+                    self.output_dir, '%s.%d.pstats' % (name, pid))
+                stats.dump_stats(path)
+                logger.info('Dumped profile of %s to %s', name, path)
+
+            for name, stacks in self._stacks.items():
+                path = os.path.join(
+                    self.output_dir, '%s.%d.collapsed' % (name, pid))
+                with open(path, 'w') as f:
+                    for stack, count in stacks.most_common():
+                        f.write('%s %d\n' % (stack, count))
+                logger.info('Dumped stack samples of %s to %s', name, path)
+
+
+def collapse_stack(frame):
+    """Return the stack of the frame in collapsed format, outermost first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s:%d' % (os.path.basename(code.co_filename),
+                                   code.co_name, code.co_firstlineno))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
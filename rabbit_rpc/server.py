@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+import functools
 import logging
+import time
+
+from pika.spec import PRECONDITION_FAILED
 
 from .base import Connector
 from .consumer import MessageDispatcher
@@ -11,8 +15,25 @@ logger = logging.getLogger(__name__)
 class RPCServer(Connector):
 
     def __init__(self, consumers, queue, *args, **kwargs):
+        """
+        :param int max_priority: Declare queues with ``x-max-priority`` so
+                                 RabbitMQ delivers high-priority messages first.
+        :param dict dispatcher_options: Keyword arguments passed to every
+                                        MessageDispatcher.
+        :param float started_at: The process start time, the cold start
+                                 time is logged once consuming starts.
+        :param float drain_timeout: Seconds to wait for in-flight messages
+                                    when shutting down gracefully.
+        """
         self._consumers = consumers
         self.default_queue = queue or self.DEFUALT_QUEUE
+        self.max_priority = kwargs.pop('max_priority', None)
+        self.dispatcher_options = kwargs.pop('dispatcher_options', None) or {}
+        self.started_at = kwargs.pop('started_at', None)
+        self.drain_timeout = kwargs.pop('drain_timeout', 30.0)
+        # Set when the queues can't be set up, reconnecting won't help.
+        self.fatal_error = None
+        self._consuming = False
 
         super(RPCServer, self).__init__(*args, **kwargs)
 
@@ -20,11 +41,23 @@ class RPCServer(Connector):
         self.setup_queues()
 
     def _setup_queue(self, queue_name):
-        dispatcher = MessageDispatcher(self._channel, self._exchange)
+        dispatcher = MessageDispatcher(
+            self._channel, self._exchange, **self.dispatcher_options)
         queue = Queue(queue_name, dispatcher)
         self._queues[queue_name] = queue
         return queue
 
+    def reset_queues(self):
+        """Drop the dispatchers bound to a previous channel, their delivery
+        tags are meaningless after reconnecting and the messages will be
+        redelivered.
+
+        """
+        for queue in self._queues.values():
+            queue.dispatcher.stop(wait=False)
+
+        self._queues = {}
+
     def setup_default_queue(self):
         return self._setup_queue(self.default_queue)
 
@@ -34,6 +67,8 @@ class RPCServer(Connector):
 
         :param str|unicode queue_name: The name of the queue to declare.
         """
+        self._consuming = False
+        self.reset_queues()
         default_queue = self.setup_default_queue()
 
         for c in self._consumers:
@@ -55,22 +90,112 @@ class RPCServer(Connector):
             queue.add_consumer(c)
 
         # setup the queue on RabbitMQ
+        arguments = None
+        if self.max_priority:
+            arguments = {'x-max-priority': self.max_priority}
+
         for queue_name in self._queues.keys():
-            self._channel.queue_declare(queue=queue_name, durable=True)
+            self._channel.queue_declare(
+                queue=queue_name, durable=True, arguments=arguments)
             self._channel.queue_bind(queue_name, exchange=self._exchange)
 
         self.start_consuming()
 
     def start_consuming(self):
+        self._consuming = True
         self._channel.add_on_cancel_callback(self.on_consumer_cancelled)
 
         for queue in self._queues.values():
-            consumer_tag = self._channel.basic_consume(
-                queue.name, queue.dispatcher)
-            queue.dispatcher.consumer_tag = consumer_tag
+            queue.dispatcher.consume(queue.name)
 
         logger.info(self._queues)
         logger.info('Start consuming..')
+        # Only a fully set up connection counts as recovered, a channel
+        # failing right after the open keeps backing off.
+        self._backoff.reset()
+        if self.started_at is not None:
+            logger.info('Cold start took %.3fs', time.time() - self.started_at)
+            self.started_at = None
+
+    def on_channel_closed(self, channel, reason):
+        # A queue declared with other arguments, e.g. before --max-priority
+        # was enabled, fails the same way on every reconnect.
+        if (not self._consuming and not self._closing and
+                getattr(reason, 'reply_code', None) == PRECONDITION_FAILED):
+            logger.error('Failed to set up the queues: %s. Delete the queues '
+                         'to redeclare them with other arguments.', reason)
+            self.fatal_error = reason
+            self._closing = True
+
+        super(RPCServer, self).on_channel_closed(channel, reason)
+
+    @property
+    def metrics(self):
+        """The admission metrics of every queue's dispatcher."""
+        return dict((name, dict(queue.dispatcher.metrics))
+                    for name, queue in self._queues.items())
+
+    def drain(self, timeout=None):
+        """Shutdown gracefully: cancel the consumers so no new message is
+        delivered, wait up to ``timeout`` seconds for the in-flight messages
+        to be replied and acknowledged, then close the connection. Must be
+        invoked on the IOLoop thread, see add_callback_threadsafe.
+
+        """
+        if self._closing:
+            return
+
+        if timeout is None:
+            timeout = self.drain_timeout
+
+        logger.info('Draining, waiting up to %.1fs for in-flight messages..',
+                    timeout)
+        self._closing = True
+        for queue in self._queues.values():
+            queue.dispatcher.cancel()
+
+        self._wait_drained(time.time() + timeout)
+
+    def _wait_drained(self, deadline):
+        pending = sum(q.dispatcher.pending for q in self._queues.values())
+        if pending and time.time() < deadline and self._channel is not None:
+            self._connection.ioloop.call_later(
+                0.1, functools.partial(self._wait_drained, deadline))
+            return
+
+        if pending:
+            logger.warning('%d messages are unfinished after draining, they '
+                           'will be redelivered.', pending)
+        else:
+            logger.info('Drained..')
+
+        for queue in self._queues.values():
+            queue.dispatcher.stop(wait=False)
+
+        self.close_channel()
+        self.close_connection()
+
+    def request_drain(self):
+        """Drain from a signal handler or another thread. If the broker is
+        unreachable, just stop reconnecting.
+
+        """
+        if self._connection is None or self._connection.is_closed:
+            self._closing = True
+        else:
+            self.add_callback_threadsafe(self.drain)
+
+    def stop(self):
+        """Invoked once the IOLoop was interrupted, e.g. by CTRL-C. Drain
+        and run the IOLoop again until the connection is closed.
+
+        """
+        if self._connection is None or self._connection.is_closed:
+            self._closing = True
+            return
+
+        self.drain()
+        self._connection.ioloop.start()
 
     def on_consumer_cancelled(self, method_frame):
         """Invoked by pika when RabbitMQ sends a Basic.Cancel for a consumer
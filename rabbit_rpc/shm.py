@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import errno
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+from .exceptions import PayloadUnavailable
+
+logger = logging.getLogger(__name__)
+
+# The name of the segment holding the message body.
+SHM_HEADER = 'shm'
+# Set by clients able to read replies from segments.
+SHM_ACCEPT = 'shm_accept'
+
+PREFIX = 'rabbit_rpc-'
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno != errno.ESRCH
+
+    return True
+
+
+def default_directory():
+    """Return /dev/shm where it exists, it is memory backed on Linux."""
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+
+    return tempfile.gettempdir()
+
+
+class SharedMemoryTransport(object):
+    """Pass large message bodies between processes on the same host through
+    files in a memory backed directory, only the file name travels through
+    RabbitMQ. Readers discard the file once the message is acked, so a
+    redelivered message can still be read; files never discarded, e.g.
+    replies of timed out calls on crashed clients, are swept after
+    ``max_age`` seconds by the process that wrote them, or by any process
+    once their writer is gone. ``max_age`` must exceed the longest time a
+    message may wait in a queue.
+
+    Files are only readable by their owner, clients and workers must run as
+    the same user.
+
+    """
+
+    def __init__(self, threshold=1024 * 1024, directory=None, max_age=600.0):
+        """
+        :param int threshold: Bodies of at least this many bytes go through
+                              shared memory.
+        :param str directory: Where the segments are created, it must be
+                              the same for the clients and the workers.
+        :param float max_age: Seconds after which unread segments are removed.
+        """
+        self.threshold = threshold
+        self.directory = directory or default_directory()
+        self.max_age = max_age
+        self._last_sweep = time.time()
+
+    def dump(self, body, headers):
+        """Return the body to publish. A large body is written to a segment
+        and its name is set in the headers.
+
+        :param str|bytes body: The encoded message body
+        :param dict headers: The message headers, updated in place
+        """
+        if len(body) < self.threshold:
+            return body
+
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+
+        name = '%s%d-%s' % (PREFIX, os.getpid(), uuid.uuid4().hex)
+        # The directory is shared, only the owner may read the payload.
+        fd = os.open(os.path.join(self.directory, name),
+                     os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+
+        headers[SHM_HEADER] = name
+        self.maybe_sweep()
+        return b''
+
+    def load(self, headers, body):
+        """Return the message body, read from its segment if it has one.
+        The segment is kept until it is discarded.
+
+        """
+        name = headers.get(SHM_HEADER) if headers else None
+        if name is None:
+            return body
+
+        path = self._path(name)
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except (IOError, OSError):
+            raise PayloadUnavailable(
+                'Shared memory payload %s is unavailable.' % name)
+
+        return body
+
+    def discard(self, headers):
+        """Remove the segment of a message once it is handled."""
+        name = headers.get(SHM_HEADER) if headers else None
+        if name is None:
+            return
+
+        try:
+            self._remove(self._path(name))
+        except PayloadUnavailable:
+            pass
+
+    def maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep >= self.max_age:
+            self._last_sweep = now
+            self.sweep()
+
+    def sweep(self):
+        """Remove the segments older than max_age written by this process or
+        by processes no longer running. Segments of other live processes may
+        belong to messages still queued, their writers sweep them.
+
+        """
+        expired = time.time() - self.max_age
+        pid = os.getpid()
+        for name in os.listdir(self.directory):
+            if not name.startswith(PREFIX):
+                continue
+
+            try:
+                writer = int(name[len(PREFIX):].split('-', 1)[0])
+            except ValueError:
+                continue
+
+            if writer != pid and is_running(writer):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.unlink(path)
+                    logger.info('Removed unread shared memory payload %s',
+                                name)
+            except OSError:
+                pass
+
+    def _path(self, name):
+        # The name comes from a message header, never follow it elsewhere.
+        if not name.startswith(PREFIX) or os.path.basename(name) != name:
+            raise PayloadUnavailable(
+                'Invalid shared memory payload name: %s' % name)
+
+        return os.path.join(self.directory, name)
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
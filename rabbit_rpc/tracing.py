@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import binascii
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Message headers, times are integer microseconds since the epoch since AMQP
+# tables can't carry floats.
+TRACE_ID = 'trace_id'
+SPAN_ID = 'span_id'
+SENT_AT = 'sent_at'
+REPLIED_AT = 'replied_at'
+TIMING = 'timing'
+
+_local = threading.local()
+
+
+def now_us():
+    return int(time.time() * 1000000)
+
+
+def new_id(nbytes=8):
+    return binascii.hexlify(os.urandom(nbytes)).decode('ascii')
+
+
+def current_trace_id():
+    """Return the trace id of the call being consumed by this thread, calls
+    sent from a consumer join its trace.
+
+    """
+    return getattr(_local, 'trace_id', None)
+
+
+def set_current_trace_id(trace_id):
+    _local.trace_id = trace_id
+
+
+class Span(object):
+    """The timing of one call, ``timing`` maps phases to microseconds."""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'timing')
+
+    def __init__(self, trace_id, span_id, name, kind, timing, parent_id=None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.timing = timing
+
+    def __repr__(self):
+        return '<Span %s %s %s/%s: %s>' % (self.kind, self.name, self.trace_id,
+                                           self.span_id, self.timing)
+
+
+class Exporter(object):
+    """Receives finished spans, subclass it to ship them to a tracing
+    backend. Spans are only built when ``enabled`` is True.
+
+    """
+    enabled = True
+
+    def export(self, span):
+        raise NotImplementedError
+
+
+class NoopExporter(Exporter):
+
+    enabled = False
+
+    def export(self, span):
+        pass
+
+
+class LoggingExporter(Exporter):
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def export(self, span):
+        logger.log(self.level, '%r', span)
+
+
+NOOP_EXPORTER = NoopExporter()
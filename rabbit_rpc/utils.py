@@ -1,3 +1,6 @@
+from collections import deque
+import random
+
 import six
 
 if six.PY3:
@@ -31,4 +34,46 @@ else:
                             break
                 self.wait(waittime)
                 result = predicate()
-            return result
\ No newline at end of file
+            return result
+
+
+class LatencyTracker(object):
+    """Keep the latest latency samples of a remote call."""
+
+    def __init__(self, size=100, min_samples=20):
+        self._samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, latency):
+        self._samples.append(latency)
+
+    def percentile(self, percent):
+        """Return the percentile of the samples, or None if there are not
+        enough samples yet.
+
+        """
+        if len(self._samples) < self.min_samples:
+            return None
+
+        samples = sorted(self._samples)
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+
+class Backoff(object):
+    """Jittered exponential backoff between reconnection attempts."""
+
+    def __init__(self, initial=1.0, maximum=60.0, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def next_delay(self):
+        """Return the seconds to wait before the next attempt."""
+        cap = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return random.uniform(self.initial / 2.0, max(cap, self.initial / 2.0))
+
+    def reset(self):
+        self.attempts = 0
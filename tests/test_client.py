@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import pika
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from rabbit_rpc.breaker import CircuitBreaker
+from rabbit_rpc.client import RPCClient
+from rabbit_rpc.exceptions import CircuitOpenError
+from rabbit_rpc.utils import LatencyTracker
+
+
+@pytest.fixture
+def client():
+    with mock.patch('rabbit_rpc.client.pika.BlockingConnection'):
+        yield RPCClient('amqp://localhost', failure_threshold=2,
+                        reset_timeout=10)
+
+
+def response(corr_id, body=b'"ok"'):
+    return (None, None, pika.BasicProperties(correlation_id=corr_id,
+                                             headers={}), body)
+
+
+@mock.patch('rabbit_rpc.breaker.time')
+def test_breaker_opens_after_consecutive_failures(time):
+    time.time.return_value = 100.0
+    breaker = CircuitBreaker('add', failure_threshold=2, reset_timeout=10)
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+@mock.patch('rabbit_rpc.breaker.time')
+def test_breaker_lets_a_single_probe_through_when_half_open(time):
+    time.time.return_value = 100.0
+    breaker = CircuitBreaker('add', failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+
+    time.time.return_value = 110.0
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.time.return_value = 120.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+@mock.patch('rabbit_rpc.breaker.time')
+def test_probe_is_recorded_when_publishing_fails(time, client):
+    time.time.return_value = 100.0
+    client.channel.basic_publish.side_effect = TypeError('not serializable')
+    for _ in range(2):
+        with pytest.raises(TypeError):
+            client.call_add(1, 1, timeout=1)
+
+    with pytest.raises(CircuitOpenError):
+        client.call_add(1, 1, timeout=1)
+
+    # The failed probe opens the circuit again instead of blocking it.
+    time.time.return_value = 110.0
+    with pytest.raises(TypeError):
+        client.call_add(1, 1, timeout=1)
+
+    time.time.return_value = 120.0
+    assert client.get_breaker('add').allow()
+
+
+def test_latency_percentile_needs_enough_samples():
+    tracker = LatencyTracker(size=10, min_samples=5)
+    for latency in range(4):
+        tracker.add(latency)
+    assert tracker.percentile(95) is None
+
+    for latency in range(4, 20):
+        tracker.add(latency)
+    # Only the latest 10 samples are kept.
+    assert tracker.percentile(0) == 10
+    assert tracker.percentile(100) == 19
+
+
+def test_discarded_response_is_dropped(client):
+    client.discard_response('a')
+    client.on_response(*response('a'))
+
+    assert 'a' not in client._results
+    assert 'a' not in client._discarded
+
+
+def test_discard_response_of_none_result(client):
+    client.on_response(*response('a', b'null'))
+    client.discard_response('a')
+
+    assert 'a' not in client._results
+    assert 'a' not in client._discarded
+
+
+@mock.patch('rabbit_rpc.client.time')
+def test_discarded_ids_expire(time, client):
+    time.time.return_value = 100.0
+    client.discard_response('a')
+
+    time.time.return_value = 100.0 + client.DISCARD_TTL + 1
+    client.discard_response('b')
+
+    assert list(client._discarded) == ['b']
+
+
+def test_discarded_ids_are_bounded(client):
+    client.MAX_DISCARDED = 2
+    for corr_id in 'abc':
+        client.discard_response(corr_id)
+
+    assert list(client._discarded) == ['b', 'c']
+
+
+def test_hedged_response_wins(client):
+    hedged = []
+
+    def hedge():
+        hedged.append('b')
+        return 'b'
+
+    def process_data_events():
+        if hedged:
+            client.on_response(*response('b', b'"hedged"'))
+
+    client.connection.process_data_events = process_data_events
+    assert client.get_response('a', timeout=1, hedge=hedge,
+                               hedge_delay=0) == 'hedged'
+
+    # The late response of the original call is dropped.
+    assert list(client._discarded) == ['a']
+    client.on_response(*response('a'))
+    assert not client._results
+    assert not client._discarded
+
+
+def test_original_response_wins(client):
+    hedge = mock.Mock(return_value='b')
+    client.connection.process_data_events = \
+        lambda: client.on_response(*response('a'))
+
+    assert client.get_response('a', timeout=1, hedge=hedge,
+                               hedge_delay=10) == 'ok'
+    assert not hedge.called
+    assert not client._discarded
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pika
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from rabbit_rpc.consumer import (OVERLOAD_PAUSE, OVERLOAD_REPLY,
+                                 OVERLOAD_REQUEUE, MessageDispatcher, consumer)
+from rabbit_rpc.exceptions import ERROR_FLAG, HAS_ERROR, OVERLOADED
+from rabbit_rpc.idempotency import MemoryStore
+
+
+@consumer()
+def add(a, b):
+    return a + b
+
+
+class SyncExecutor(object):
+
+    def submit(self, fn, *args):
+        fn(*args)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def make_dispatcher(sync=False, **options):
+    dispatcher = MessageDispatcher(mock.MagicMock(), **options)
+    dispatcher.register(add)
+    dispatcher.consume('default')
+    if sync:
+        dispatcher._executor = SyncExecutor()
+    return dispatcher
+
+
+def deliver(dispatcher, delivery_tag, body=None, **headers):
+    headers.setdefault('consumer_name', 'add')
+    if body is None:
+        body = json.dumps({'args': [1, 2], 'kwargs': {}})
+    props = pika.BasicProperties(headers=headers, reply_to='callback')
+    dispatcher(dispatcher._channel, mock.Mock(delivery_tag=delivery_tag),
+               props, body)
+
+
+def replies(dispatcher):
+    return [(json.loads(c[1]['body']), c[1]['properties'].headers[ERROR_FLAG])
+            for c in dispatcher._channel.basic_publish.call_args_list]
+
+
+def acked(dispatcher):
+    return [c[0][0] for c in dispatcher._channel.basic_ack.call_args_list]
+
+
+def properties():
+    return pika.BasicProperties(headers={'consumer_name': 'add'},
+                                reply_to='callback')
+
+
+def test_admit_under_the_limit():
+    dispatcher = make_dispatcher(max_pending=2)
+
+    assert dispatcher.admit(1, properties())
+    assert dispatcher.admit(2, properties())
+    assert dispatcher.pending == 2
+    assert dispatcher.metrics['accepted'] == 2
+    assert not dispatcher._channel.basic_cancel.called
+
+
+def test_pause_until_half_drained():
+    dispatcher = make_dispatcher(max_pending=2, overload_policy=OVERLOAD_PAUSE)
+    channel = dispatcher._channel
+    for delivery_tag in range(3):
+        assert dispatcher.admit(delivery_tag, properties())
+
+    assert dispatcher.pending == 3
+    assert channel.basic_cancel.called
+
+    dispatcher.release()
+    assert not channel.connection.ioloop.add_callback_threadsafe.called
+
+    dispatcher.release()
+    channel.connection.ioloop.add_callback_threadsafe.assert_called_once_with(
+        dispatcher.resume)
+    dispatcher.resume()
+    assert channel.basic_consume.call_count == 2
+
+
+def test_requeue_rejects_and_pauses():
+    dispatcher = make_dispatcher(max_pending=1,
+                                 overload_policy=OVERLOAD_REQUEUE)
+    channel = dispatcher._channel
+    assert dispatcher.admit(1, properties())
+    assert not dispatcher.admit(2, properties())
+
+    channel.basic_reject.assert_called_once_with(2, requeue=True)
+    assert channel.basic_cancel.called
+    assert dispatcher.pending == 1
+    assert dispatcher.metrics['rejected'] == 1
+
+
+def test_pause_resumes_if_already_drained():
+    dispatcher = make_dispatcher(max_pending=1,
+                                 overload_policy=OVERLOAD_REQUEUE)
+    dispatcher.pause()
+
+    assert not dispatcher._paused
+    assert dispatcher._channel.basic_consume.call_count == 2
+
+
+def test_reply_overloaded():
+    dispatcher = make_dispatcher(max_pending=1, overload_policy=OVERLOAD_REPLY)
+    assert dispatcher.admit(1, properties())
+    assert not dispatcher.admit(2, properties())
+
+    assert replies(dispatcher) == [('Server is overloaded.', OVERLOADED)]
+    assert acked(dispatcher) == [2]
+    assert dispatcher.pending == 1
+
+
+def test_release_after_the_call():
+    dispatcher = make_dispatcher(sync=True, max_pending=1)
+    deliver(dispatcher, 1)
+
+    assert replies(dispatcher) == [(3, 0)]
+    assert acked(dispatcher) == [1]
+    assert dispatcher.pending == 0
+
+
+def test_release_undecodable_message():
+    dispatcher = make_dispatcher(sync=True, max_pending=1)
+    deliver(dispatcher, 1, body=b'{bad')
+
+    assert replies(dispatcher)[0][1] == HAS_ERROR
+    assert acked(dispatcher) == [1]
+    assert dispatcher.pending == 0
+
+
+def test_release_when_submit_fails():
+    dispatcher = make_dispatcher(max_pending=1)
+    dispatcher._executor = mock.Mock()
+    dispatcher._executor.submit.side_effect = RuntimeError('shutdown')
+
+    with pytest.raises(RuntimeError):
+        deliver(dispatcher, 1)
+    assert dispatcher.pending == 0
+
+
+@consumer()
+def sub(a, b):
+    return a - b
+
+
+class DeferredExecutor(SyncExecutor):
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args):
+        self.calls.append((fn, args))
+
+    def run(self):
+        for fn, args in self.calls:
+            fn(*args)
+
+
+def make_idempotent_dispatcher():
+    dispatcher = make_dispatcher(sync=True,
+                                 idempotency_store=MemoryStore())
+    dispatcher.register(sub)
+    return dispatcher
+
+
+def test_duplicate_is_answered_from_the_store():
+    dispatcher = make_idempotent_dispatcher()
+    handler = dispatcher._registries['add']
+    with mock.patch.object(handler, 'consume',
+                           wraps=handler.consume) as consume:
+        deliver(dispatcher, 1, idempotency_key='k')
+        deliver(dispatcher, 2, idempotency_key='k')
+
+    assert consume.call_count == 1
+    assert replies(dispatcher) == [(3, 0), (3, 0)]
+    assert acked(dispatcher) == [1, 2]
+    assert dispatcher.metrics['duplicates'] == 1
+
+
+def test_duplicates_wait_for_the_running_call():
+    dispatcher = make_idempotent_dispatcher()
+    dispatcher._executor = executor = DeferredExecutor()
+    deliver(dispatcher, 1, idempotency_key='k')
+    deliver(dispatcher, 2, idempotency_key='k')
+
+    assert len(executor.calls) == 1
+    assert not acked(dispatcher)
+
+    executor.run()
+    assert replies(dispatcher) == [(3, 0), (3, 0)]
+    assert sorted(acked(dispatcher)) == [1, 2]
+    assert not dispatcher._running_keys
+
+
+def test_failed_call_is_not_stored():
+    dispatcher = make_idempotent_dispatcher()
+    deliver(dispatcher, 1, body=json.dumps({'args': [1]}),
+            idempotency_key='k')
+    deliver(dispatcher, 2, idempotency_key='k')
+
+    assert [flag for _, flag in replies(dispatcher)] == [HAS_ERROR, 0]
+    assert replies(dispatcher)[1] == (3, 0)
+
+
+def test_undecodable_call_does_not_block_its_key():
+    dispatcher = make_idempotent_dispatcher()
+    deliver(dispatcher, 1, body=b'{bad', idempotency_key='k')
+    deliver(dispatcher, 2, idempotency_key='k')
+
+    assert replies(dispatcher)[1] == (3, 0)
+    assert acked(dispatcher) == [1, 2]
+    assert not dispatcher._running_keys
+
+
+def test_keys_are_scoped_by_consumer():
+    dispatcher = make_idempotent_dispatcher()
+    deliver(dispatcher, 1, idempotency_key='k')
+    deliver(dispatcher, 2, consumer_name='sub', idempotency_key='k')
+
+    assert replies(dispatcher) == [(3, 0), (-1, 0)]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import importlib
+import json
+import os
+import sys
+
+import pytest
+
+from rabbit_rpc.consumer import LazyConsumer
+from rabbit_rpc.manifest import collect_consumers, dump_manifest, load_manifest
+
+SOURCE = '''
+from rabbit_rpc import consumer
+
+
+@consumer()
+def add(a, b):
+    return a + b
+
+
+@consumer(queue='slow')
+def sub(a, b):
+    return a - b
+'''
+
+
+@pytest.fixture
+def module(tmpdir, monkeypatch):
+    tmpdir.join('manifest_consumers.py').write(SOURCE)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    yield importlib.import_module('manifest_consumers')
+    sys.modules.pop('manifest_consumers', None)
+
+
+@pytest.fixture
+def path(tmpdir, module):
+    path = str(tmpdir.join('manifest.json'))
+    locations = [(module.__name__, attr, c)
+                 for attr, c in collect_consumers(module)]
+    dump_manifest(path, locations, ['manifest_consumers'])
+    return path
+
+
+def test_load_lazy_consumers(path, module):
+    consumers = load_manifest(path, ['manifest_consumers'])
+
+    assert all(isinstance(c, LazyConsumer) for c in consumers)
+    assert [(c.name, c.queue) for c in consumers] == [('add', None),
+                                                      ('sub', 'slow')]
+    assert consumers[0].consume(1, 2) == 3
+    assert consumers[0].load() is module.add
+
+
+def test_missing_manifest(tmpdir):
+    assert load_manifest(str(tmpdir.join('missing.json'))) is None
+
+
+def test_outdated_version(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest['version'] = 0
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+
+    assert load_manifest(path, ['manifest_consumers']) is None
+
+
+def test_other_requested_modules(path):
+    assert load_manifest(path, ['other.consumers']) is None
+    assert load_manifest(path) is None
+
+
+def test_changed_source(path, module):
+    mtime = os.path.getmtime(module.__file__)
+    os.utime(module.__file__, (mtime + 10, mtime + 10))
+
+    assert load_manifest(path, ['manifest_consumers']) is None